@@ -1,8 +1,20 @@
 from pymol import cmd, util, keywords, preset
 import xmlrpclib
+import json
+import SocketServer
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 import argparse
+import socket
+import struct
 import sys
+import threading
+
+# msgpack marshals small payloads far faster than XML-RPC, but it isn't
+# shipped with pymol, so the stream protocol also supports plain json.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Mapping of legal module names to modules
 MODULES = {"util": util, "preset": preset}
@@ -11,47 +23,188 @@ arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument('--rpc-host', default="localhost", type=str)
 arg_parser.add_argument('--rpc-port', default=9123, type=int)
 arg_parser.add_argument('--rpc-bg', action='store_true', default=False)
+arg_parser.add_argument('--rpc-protocol', default="xmlrpc",
+                        choices=["xmlrpc", "msgpack", "json"])
 
 # Current rpc server
 server = None
 
-class PymolServer(SimpleXMLRPCServer) :
-    def __init__ (self, *args) :
-        try:
-            SimpleXMLRPCServer.__init__(self, *args)
-        except:
-            cmd.quit(1)
+def set_socket_options(sock):
+    # Each RPC is a few hundred bytes, so Nagle's algorithm can add up to
+    # 40 ms of latency per call; disable it. Keepalive lets us notice dead
+    # clients in long-lived sessions. Accepted sockets inherit both options
+    # from the listening socket.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+# Method lookup and invocation shared by both server flavours. The server
+# classes call init_dispatcher() once their socket is set up.
+class PymolDispatcher(object):
+    def init_dispatcher(self):
+        # Pymol's cmd module is not thread-safe, so the command invocation
+        # itself is serialised under this lock; request parsing and
+        # marshalling still run concurrently.
+        self._cmd_lock = threading.Lock()
+        self.reload_keywords()
+
+    # Build a flat table of every method we can serve, so that dispatch is
+    # a single dict lookup rather than a chain of keyword, cmd and module
+    # checks. Entries added later take precedence, mirroring the original
+    # lookup order: command keywords, then cmd attributes, then the
+    # "util."/"preset." modules. Call this again if pymol registers new
+    # keywords at runtime.
+    def reload_keywords(self):
+        table = {"ping": lambda *args, **kwargs: "pong"}
+        for module_name, module in MODULES.items():
+            for name in dir(module):
+                if name.startswith("_"):
+                    continue
+                func = getattr(module, name)
+                if callable(func):
+                    table["{}.{}".format(module_name, name)] = func
+        for name in dir(cmd):
+            if name.startswith("_"):
+                continue
+            func = getattr(cmd, name)
+            if callable(func):
+                table[name] = func
+        for name, entry in keywords.get_command_keywords().items():
+            table[name] = entry[0]
+        self._dispatch_table = table
 
     def _dispatch (self, method, params) :
+        # Split params into positional and keyword arguments. The bound
+        # methods are hoisted to locals and the dict check uses an exact
+        # type test: the unmarshallers only ever hand us plain dicts, and
+        # this loop runs for every argument of every call.
         args = []
         kwargs = {}
+        kw_update = kwargs.update
+        args_append = args.append
         for param in params:
-            if isinstance(param, dict):
-                kwargs.update(param)
+            if type(param) is dict:
+                kw_update(param)
             else:
-                args.append(param)
-
-        func = None
-        # Look up method from keywords first
-        if method == "ping":
-            return "pong"
-        elif method in keywords.get_command_keywords():
-            func = keywords.get_command_keywords()[method][0]
-        elif hasattr(cmd, method) :
-            func = getattr(cmd, method)
-        elif method.startswith("preset.") or method.startswith("util."):
-            module, function = method.split(".")
-            if module in MODULES and hasattr(MODULES[module], function):
-                func = getattr(MODULES[module], function)
+                args_append(param)
+
+        func = self._dispatch_table.get(method)
+        if func is None:
+            # cmd attributes registered after the table was built still
+            # resolve; cache them so the next call is a plain lookup.
+            func = getattr(cmd, method, None)
+            if callable(func):
+                self._dispatch_table[method] = func
 
         if not callable(func) :
             raise ValueError("{} is not callable".format(method))
 
-        result = func(*args, **kwargs)
+        with self._cmd_lock:
+            result = func(*args, **kwargs)
         if result is None :
             result = -1
         return result
 
+# Requests are handled on one thread each, so the parsing and marshalling
+# of concurrent calls overlap.
+class PymolServer(SocketServer.ThreadingMixIn, PymolDispatcher,
+                  SimpleXMLRPCServer) :
+    # Don't let in-flight requests keep pymol alive on exit.
+    daemon_threads = True
+    # Allow a restarted server to rebind while the old socket is in
+    # TIME_WAIT.
+    allow_reuse_address = True
+
+    def server_bind(self):
+        set_socket_options(self.socket)
+        SimpleXMLRPCServer.server_bind(self)
+
+    def __init__ (self, *args) :
+        try:
+            SimpleXMLRPCServer.__init__(self, *args)
+        except:
+            cmd.quit(1)
+        self.init_dispatcher()
+
+def read_exact(sock, length):
+    # Read exactly length bytes, or return None on a closed connection.
+    chunks = []
+    while length > 0:
+        chunk = sock.recv(length)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        length -= len(chunk)
+    return "".join(chunks)
+
+class PymolStreamHandler(SocketServer.BaseRequestHandler):
+    # Serve any number of calls over one persistent connection. Each frame
+    # is a 4-byte big-endian payload length followed by the payload: a
+    # msgpack- or json-encoded [method, params] for requests, and
+    # {"result": ...} or {"error": message} for replies. Compared with
+    # XML-RPC this avoids a TCP and HTTP handshake per call and uses a much
+    # cheaper serialiser.
+    def handle(self):
+        sock = self.request
+        loads = self.server.loads
+        dumps = self.server.dumps
+        while True:
+            header = read_exact(sock, 4)
+            if header is None:
+                break
+            (length,) = struct.unpack(">I", header)
+            payload = read_exact(sock, length)
+            if payload is None:
+                break
+
+            # Serialising the reply happens inside the try so that a result
+            # the encoder can't represent becomes an error frame rather
+            # than a dropped connection, matching how the XML-RPC path
+            # returns a Fault.
+            try:
+                method, params = loads(payload)
+                reply = {"result": self.server._dispatch(method, params)}
+                data = dumps(reply)
+            except Exception as error:
+                data = dumps({"error": str(error)})
+
+            sock.sendall(struct.pack(">I", len(data)) + data)
+
+class PymolStreamServer(SocketServer.ThreadingMixIn, PymolDispatcher,
+                        SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def server_bind(self):
+        set_socket_options(self.socket)
+        SocketServer.TCPServer.server_bind(self)
+
+    def __init__(self, addr, protocol):
+        try:
+            SocketServer.TCPServer.__init__(self, addr, PymolStreamHandler)
+        except:
+            cmd.quit(1)
+
+        # There is no wire-level negotiation, so silently serving json to a
+        # client expecting msgpack would just move the failure to the
+        # client's decoder. Refuse to start instead.
+        if protocol == "msgpack" and msgpack is None:
+            sys.stderr.write("msgpack is not installed; install it or use "
+                             "--rpc-protocol json\n")
+            cmd.quit(1)
+        if protocol == "msgpack":
+            self.loads = lambda data: msgpack.unpackb(data, raw=False)
+            self.dumps = msgpack.packb
+        else:
+            self.loads = json.loads
+            self.dumps = json.dumps
+
+        self.init_dispatcher()
+
+def make_server(host, port, protocol):
+    if protocol == "xmlrpc":
+        return PymolServer((host, port))
+    return PymolStreamServer((host, port), protocol)
+
 def background(server):
     thread = threading.Thread(target=server.serve_forever)
     thread.setDaemon(1)
@@ -62,7 +215,8 @@ def foreground(server):
 
 if __name__ == "pymol":
     args = arg_parser.parse_known_args(sys.argv)
-    server = PymolServer((args[0].rpc_host, args[0].rpc_port))
+    server = make_server(args[0].rpc_host, args[0].rpc_port,
+                         args[0].rpc_protocol)
     if args[0].rpc_bg:
         background(server)
     else:
@@ -15,6 +15,8 @@ import pymol.helping
 import pymol.util
 import re
 import collections
+import sys
+from multiprocessing.pool import ThreadPool
 
 
 # Template used when writing an R method.
@@ -24,16 +26,17 @@ function({args}) {{
     .self$.rpc({call_args})
 }}""".lstrip()
 
-# Template wrapping each method definition.  We need to include base_pymolr.r
-# because it contains the definition of the BasePymol class to which we are
-# adding methods.
-R_TEMPLATE = r"""
+# Written before and after the method definitions, which are streamed out
+# one at a time rather than joined into one giant string. We need to include
+# base_pymolr.r because it contains the definition of the BasePymol class to
+# which we are adding methods.
+R_HEADER = r"""
 #' @include base_pymolr.r
 BasePymol$methods(
-{methods}
-)
 """.lstrip()
 
+R_FOOTER = "\n)\n"
+
 # Written to .rd files for each method as the usage section.
 USAGE_TEMPLATE = r"""
 \usage{{
@@ -63,52 +66,69 @@ DOCSTRING_TEMPLATE = r"""
 See: \\code{{\\link{{{link}}}}}.
 """.lstrip()
 
-# Pymol describes the arguments to each command as free-ish text. These regexes
-# capture the most common conventions.
-ARG_REGEXES = (
-    # Matches arguments of the form "argument = type: description".
-    # For example, the "load" command.
-    re.compile(r"""
-        ^(?P<arg>\w+)   # Argument name
-        \s+=\s+         # Separating " = "
-        (?P<type>\w+):  # Type name, terminated by a colon
-        \s(?P<desc>.*)$ # Description to end of line
-        """, re.DOTALL | re.VERBOSE),
-    # Arguments without a type: "argument = description".
-    # For example, the "fetch" command.
-    re.compile(r"""
-        ^(?P<arg>\w+)   # Argument name
-        \s+=\s+         # Seperating " = "
-        (?P<desc>\S.*)$ # Description starts with first non-whitespace char
-        """, re.DOTALL | re.VERBOSE),
-
-    # Some commands specify a value range: "argument < val: description".
-    # For example, the "zoom" command.
-    re.compile(r"""
-        ^(?P<arg>\w+)   # Argument name
+# Pymol describes the arguments to each command as free-ish text. This regex
+# captures the most common conventions as alternatives of a single pattern,
+# so that each argument paragraph is scanned once rather than once per
+# convention. The alternatives are tried in order:
+#
+# "argument = type: description", for example the "load" command.
+# "argument = description", for example the "fetch" command.
+# "argument < val: description", for example the "zoom" command.
+ARG_REGEX = re.compile(r"""
+    ^(?P<arg>\w+)           # Argument name
+    (?:
+        \s+=\s+             # Separating " = "
+        (?:
+            (?P<type>\w+):  # Type name, terminated by a colon
+            \s(?P<tdesc>.*) # Description to end of line
+        |
+            (?P<desc>\S.*)  # Untyped description starts with first
+                            # non-whitespace char
+        )
+    |
         \s+
         (?P<range>
-            [<>]\s+     # Operator (">" or "<")
-            \d+         # Value range
+            [<>]\s+         # Operator (">" or "<")
+            \d+             # Value range
         )
-        :?\s+           # Optionally followed by a colon
-        (?P<desc>\S.*)$ # Description starts with non-whistespace char
-        """, re.DOTALL | re.VERBOSE),
-)
+        :?\s+               # Optionally followed by a colon
+        (?P<rdesc>\S.*)     # Description starts with non-whistespace char
+    )$
+    """, re.DOTALL | re.VERBOSE)
+
+# Bound "match" method of the regex above. The argument-matching loop runs
+# for every argument paragraph of every command, so we bind the method once
+# here rather than looking up "match" on each use.
+_ARG_MATCHER = ARG_REGEX.match
 
 # We represent a selection as a heading and a list of lines.
 Section = collections.namedtuple("Section", ["heading", "lines"])
 
+# Sections skipped when writing Rd files: they have either already been
+# handled explicitly or should not appear. Hoisted to module scope so the
+# tuple is not rebuilt for every command.
+_IGNORED_PREFIXES = ("DESCRIPTION", "USAGE", "PYMOL API", "EXAMPLE")
+
 # We need to mangle some words that are keywords in R but not python.
+# These helpers are called for every line of every docstring, so each has
+# a cheap fast path that avoids the regex engine in the common case.
 def escape_keywords(str):
+    if "function" not in str:
+        return str
     return re.sub(r"\bfunction\b", ".function", str)
 
 # R doesn't have raw strings, so we will need to escape single quotes.
+# The regex is only needed to honour pre-existing backslash escapes; most
+# strings contain none, and a plain replace is equivalent then.
 def escape_quotes(string):
+    if "\\" not in string:
+        return string.replace("'", "\\'")
     return re.sub(r"(?<!\\)'", r"\\'", string)
 
 # When writing .rd files, we will need to escape braces.
 def escape_braces(string):
+    if "\\" not in string:
+        return string.replace("{", "\\{").replace("}", "\\}")
     return re.sub(r"(?<!\\)([{}])", r"\\\1", string)
 
 # Given a list of arguments to be documented in a .rd file, escape any keywords
@@ -121,13 +141,17 @@ def escape_args_rd(args):
         escaped.append(arg)
     return escaped
 
-# Remove leading and trailing blank lines from an array of lines.
+# Remove leading and trailing blank lines from an array of lines. We walk
+# indices and take a single slice rather than popping from the front, which
+# shifts every remaining element on each call.
 def strip_blank(lines):
-    while len(lines) > 0 and not lines[0]:
-        lines.pop(0)
-    while len(lines) > 0 and not lines[-1]:
-        lines.pop()
-    return lines
+    start = 0
+    end = len(lines)
+    while start < end and not lines[start]:
+        start += 1
+    while end > start and not lines[end - 1]:
+        end -= 1
+    return lines[start:end]
 
 # Parse a docstring into a list of sections.
 #
@@ -144,10 +168,10 @@ def docstring_sections(docstring):
             continue
 
         # If this is a section heading, start a new section. Here, we check for
-        # non-space chars in the first column.
-        heading_match = re.match(r"^[^ ].*$", line)
-        if heading_match:
-            sections.append(Section(heading_match.group(0), []))
+        # non-space chars in the first column. A plain character test avoids
+        # running the regex engine on every line of every docstring.
+        if line and line[0] != " ":
+            sections.append(Section(line, []))
         else:
             # Add unnamed section if we haven't encountered a header yet
             if len(sections) == 0:
@@ -165,15 +189,19 @@ def docstring_sections(docstring):
 # describe most PyMol commands, so we also write a separate file documenting
 # the method fully. I write the .rd file directly because I think going via
 # roxygen2 would just make life more complicated.
-def docstring_to_rd(cmd_name, args_r, sections):
-    # Build up a list of lines in the output
-    out_rd = []
-    out_rd.extend([
-        r"\name{{{name}}}".format(name=cmd_name),
-        # Allow lookup by "help('Pymol$name')"
-        r"\alias{{Pymol${name}}}".format(name=cmd_name),
-        r"\title{{Execute PyMol '{name}' command}}".format(name=cmd_name),
-    ])
+def docstring_to_rd(fh, cmd_name, args_r, sections):
+    # Stream each line straight to the file rather than accumulating the
+    # whole document and joining it at the end.
+    def out_rd(line):
+        fh.write(line)
+        fh.write("\n")
+
+    # Plain concatenation for the single-substitution lines below; it skips
+    # the format mini-language parser, which adds up over many commands.
+    out_rd("\\name{" + cmd_name + "}")
+    # Allow lookup by "help('Pymol$name')"
+    out_rd("\\alias{Pymol$" + cmd_name + "}")
+    out_rd("\\title{Execute PyMol '" + cmd_name + "' command}")
     # If there is only one section, it should be the description
     if len(sections) == 1 and None in sections:
         sections["DESCRIPTION"] = sections[None]
@@ -182,75 +210,68 @@ def docstring_to_rd(cmd_name, args_r, sections):
     # \description
     if "DESCRIPTION" in sections:
         desc = "\n".join(strip_blank(sections["DESCRIPTION"]))
-        out_rd.append(DESCRIPTION_TEMPLATE.format(description=desc))
+        out_rd(DESCRIPTION_TEMPLATE.format(description=desc))
     else:
-        out_rd.append(r"\description{Not described by PyMol.}")
+        out_rd(r"\description{Not described by PyMol.}")
 
     # \usage
-    out_rd.append(USAGE_TEMPLATE.format(
+    out_rd(USAGE_TEMPLATE.format(
         name=cmd_name,
         args=", ".join(escape_args_rd(args_r))
     ))
 
-    # These have either already been seen or should not appear.
-    ignored_sections = (
-        re.compile("^DESCRIPTION"),
-        re.compile("^USAGE"),
-        re.compile("^PYMOL API"),
-        re.compile("^EXAMPLE"),
-    )
     for section, lines in sections.iteritems():
         if len(lines) == 0 or len(strip_blank(lines)) == 0:
             continue
 
         elif section == "NOTES":
             note = "\n".join(strip_blank(lines))
-            out_rd.append(NOTE_TEMPLATE.format(note=note))
+            out_rd(NOTE_TEMPLATE.format(note=note))
         elif section == "ARGUMENTS":
-            out_rd.append(r"\arguments{")
+            out_rd(r"\arguments{")
             # Split into paragraphs by joining by newline and splitting on
             # pairs of newlines
             argument_lines = "\n".join(strip_blank(lines)).split("\n\n")
             for argument_spec in argument_lines:
-                for regex in ARG_REGEXES:
-                    arg_match = regex.match(argument_spec)
-                    if arg_match is not None:
-                        break
+                arg_match = _ARG_MATCHER(argument_spec)
 
                 if arg_match is None:
-                    item = (r"\item{{Extra (from PyMol help text)}}{{"
-                        r"{definition}"
-                        r"}}").format(definition=argument_spec)
+                    item = ("\\item{Extra (from PyMol help text)}{"
+                        + argument_spec
+                        + "}")
                 else:
+                    # Exactly one of the description groups matched,
+                    # depending on which alternative applied.
+                    definition = next(
+                        desc for desc in arg_match.group(
+                            "tdesc", "desc", "rdesc")
+                        if desc is not None)
                     item = r"\item{{{arg}}}{{{definition}}}".format(
                         arg = arg_match.group("arg"),
-                        definition = arg_match.group("desc"))
+                        definition = definition)
 
-                out_rd.append(item)
-            out_rd.append(r"}")
+                out_rd(item)
+            out_rd(r"}")
         elif section == "SEE ALSO":
-            out_rd.append(r"\seealso{")
-            out_rd.append(r"\itemize{")
+            out_rd(r"\seealso{")
+            out_rd(r"\itemize{")
             # Join lines and then split on comma to give the list of commands
             for arg in re.split(r",\s*", ", ".join(lines)):
                 if arg == "":
                     continue
-                out_rd.append(r"\item \code{{\link{{Pymol${cmd}}}}}".format(
-                        cmd=arg
-                    ))
+                out_rd("\\item \\code{\\link{Pymol$" + arg + "}}")
 
-            out_rd.append(r"}")
-            out_rd.append(r"}")
+            out_rd(r"}")
+            out_rd(r"}")
         else:
             if section is None:
                 section = "Introduction"
-            if any(regex.match(section) for regex in ignored_sections):
+            if section.startswith(_IGNORED_PREFIXES):
                 continue
-            out_rd.append(r"\section{{{}}}{{".format(
-                section.strip().title()))
-            out_rd.extend(strip_blank(lines))
-            out_rd.append(r"}")
-    return "\n".join(out_rd)
+            out_rd("\\section{" + section.strip().title() + "}{")
+            for line in strip_blank(lines):
+                out_rd(line)
+            out_rd(r"}")
 
 # Convert a default argument value to a value that can be understood by R.
 # We do the following conversions:
@@ -260,18 +281,58 @@ def docstring_to_rd(cmd_name, args_r, sections):
 # None -> NULL
 #
 # For every other value, we just use its repr().
+#
+# Many commands share the same scalar defaults (0, None, "all", ...), so the
+# conversions are cached per distinct value. The cache key includes the type
+# because values like 1 and True hash equally but repr differently.
+_to_r_scalar_cache = {}
+
+
+def _to_r_scalar(arg):
+    try:
+        key = (type(arg), arg)
+        result = _to_r_scalar_cache.get(key)
+        if result is None:
+            result = "NULL" if arg is None else repr(arg)
+            _to_r_scalar_cache[key] = result
+        return result
+    except TypeError:
+        # Unhashable value; convert it without caching.
+        return "NULL" if arg is None else repr(arg)
+
+
 def to_r(arg):
-    if isinstance(arg, list) or isinstance(arg, tuple):
-        formatted_args = [to_r(x) for x in arg]
-        return "c({})".format(", ".join(formatted_args))
-    elif isinstance(arg, dict):
-        joined_args = ["`{}`={}".format(n, to_r(v))
-                       for n, v in arg.iteritems()]
-        return "list({})".format(", ".join(joined_args))
-    elif arg is None:
-        return "NULL"
-    else:
-        return repr(arg)
+    # Walk containers with an explicit stack instead of recursion, which
+    # pays a Python frame per nesting level. Each frame holds the fragments
+    # formatted so far, the wrapper applied when the frame completes, the
+    # prefix the parent expects ("`name`=" for dict entries), and the
+    # remaining child values, reversed so pop() yields them left to right.
+    result = None
+    stack = [([], "{}", "", [("", arg)])]
+    while stack:
+        parts, template, prefix, items = stack[-1]
+        if items:
+            item_prefix, item = items.pop()
+            if isinstance(item, list) or isinstance(item, tuple):
+                # Lists to vectors: [1,2,3] -> c(1,2,3)
+                stack.append(([], "c({})", item_prefix,
+                              [("", x) for x in reversed(item)]))
+            elif isinstance(item, dict):
+                # Dicts to lists: {"a": 1, "b":2} -> list(`a`=1, `b`=2)
+                entries = [("`{}`=".format(name), value)
+                           for name, value in item.iteritems()]
+                entries.reverse()
+                stack.append(([], "list({})", item_prefix, entries))
+            else:
+                parts.append(item_prefix + _to_r_scalar(item))
+        else:
+            stack.pop()
+            text = template.format(", ".join(parts))
+            if stack:
+                stack[-1][0].append(prefix + text)
+            else:
+                result = text
+    return result
 
 # Given a python command, build the argument lists required for R.
 
@@ -286,40 +347,48 @@ def to_r(arg):
 # For example, the arguments of  "def foo(a, b=123, *args):" are converted to
 # "a, b=123, ...".
 
+# Cache of inspect.getargspec results keyed by function id. Many pymol
+# commands are aliases for the same underlying callable, and getargspec
+# rebuilds its result on every call. The functions are kept alive by the
+# cmds dict for the whole run, so ids cannot be recycled.
+_argspec_cache = {}
+
+
 def build_r_args(cmd_name, cmd):
     fn = cmd[0]
-    argspec = inspect.getargspec(fn)
-    # print inspect.getargspec(fn)
-
-    # Collect all arguments with a default
-    # Remove the _self parameter -- it's an internal thing for pymol
-    kwargs = {}
-    if argspec.defaults is not None:
-        kwargs = {arg: to_r(val)
-                  for arg, val in zip(
-                      reversed(argspec.args),
-                      reversed(argspec.defaults))
-                  if not arg.startswith("_")}
-
-    # args_r are the R function parameters: function(args_r)
-    # Collect args without a default parameter. These will be used in the R
-    # function definition
-    args_r = [arg for arg in argspec.args
-              if not arg.startswith("_") and arg not in kwargs]
-
-    # append kwargs to function parameters in "R" format (name=val)
-    args_r.extend(["{}={}".format(escape_keywords(name), kwargs[name])
-                   for name in argspec.args
-                   if not name.startswith("_") and name in kwargs])
+    argspec = _argspec_cache.get(id(fn))
+    if argspec is None:
+        argspec = inspect.getargspec(fn)
+        _argspec_cache[id(fn)] = argspec
+
+    # Walk the argument list once, building both lists as we go. Defaults
+    # belong to the last len(defaults) arguments, so an argument's index
+    # tells us whether it has one.
+    defaults = argspec.defaults or ()
+    num_positional = len(argspec.args) - len(defaults)
+
+    # args_r are the R function parameters: function(args_r). Arguments
+    # without a default come first; those with one follow in "R" format
+    # (name=val).
+    args_r = []
+    default_args_r = []
     # call_args_r: this is the arguments passed to xml.do
     # First, we add the method name. Call repr to add quotes
     call_args_r = [repr(cmd_name)]
 
-    # This is the same list of arguments in the method signature, but
-    # without the default values.
-    call_args_r.extend([escape_keywords(a)
-                        for a in argspec.args
-                        if not a.startswith("_")])
+    for index, name in enumerate(argspec.args):
+        # Remove the _self parameter -- it's an internal thing for pymol
+        if name.startswith("_"):
+            continue
+        # call_args_r gets every argument, without its default value.
+        call_args_r.append(escape_keywords(name))
+        if index < num_positional:
+            args_r.append(name)
+        else:
+            default_args_r.append("{}={}".format(
+                escape_keywords(name),
+                to_r(defaults[index - num_positional])))
+    args_r.extend(default_args_r)
 
     # Add a parameter for *args and **kwargs.
     if argspec.varargs is not None or argspec.keywords is not None:
@@ -329,15 +398,25 @@ def build_r_args(cmd_name, cmd):
     return args_r, call_args_r
 
 
+# Write the documentation file for a single method. This runs on a worker
+# thread, so the file I/O overlaps with formatting the next command; it only
+# touches its own arguments and file, making it thread-safe.
+def write_rd(rdoc_file, cmd_name, args_r, doc_sections):
+    # A 64 KiB buffer is larger than almost every Rd file, so the
+    # line-by-line writes coalesce into a single OS write.
+    with open(rdoc_file, "w", 65536) as fh:
+        docstring_to_rd(fh, cmd_name, args_r, doc_sections)
+
+
 def dump_cmds():
-    methods = []
     # Common commands
     cmds = pymol.keywords.get_command_keywords()
     # Some commands are separate, but we don't want to add methods for those
-    # that just return a help message:
-    pymol_helping = vars(pymol.helping).values()
+    # that just return a help message. A set of function ids gives O(1)
+    # rejection instead of scanning a list per command.
+    helping_ids = {id(fn) for fn in vars(pymol.helping).values()}
     for cmd_name, cmd in pymol.keywords.get_help_only_keywords().iteritems():
-        if cmd[0] not in pymol_helping:
+        if id(cmd[0]) not in helping_ids:
             cmds[cmd_name] = cmd
 
     # Add functions from the presets module and the util module
@@ -348,10 +427,21 @@ def dump_cmds():
     for name, func in preset_functions:
         cmds["preset.{}".format(name)] = (func,)
 
+    # Stream each method definition to stdout as it is built, rather than
+    # collecting them all and joining one enormous string at the end. The
+    # flag tracks whether a ",\n" separator is needed before a method.
+    out = sys.stdout.write
+    out(R_HEADER)
+    first_method = True
+    python_help = pymol.cmd.python_help
+    # Rd files are written on worker threads so the I/O overlaps with
+    # formatting the next command.
+    pool = ThreadPool(4)
+    pending_rds = []
     for cmd_name, cmd in cmds.iteritems():
         # Skip commands beginning with "_". I assume that they are internal.
         # Some are just warnings about python keywordss.
-        if cmd_name.startswith("_") or cmd[0] is pymol.cmd.python_help:
+        if cmd_name.startswith("_") or cmd[0] is python_help:
             continue
 
         # Get the list of args for the method and the args to be passed on.
@@ -389,15 +479,25 @@ def dump_cmds():
             args=", ".join(args_r),
             call_args=", ".join(call_args_r)
         )
-        methods.append("{}={}".format(cmd_name, fn_body))
+        if not first_method:
+            out(",\n")
+        first_method = False
+        out("{}={}".format(cmd_name, fn_body))
 
         # Create documentation file for method
         if doc_sections is not None:
             rdoc_file = "man/Pymol-method-{}.Rd".format(cmd_name)
-            with open(rdoc_file, "w") as fh:
-                fh.write(docstring_to_rd(cmd_name, args_r, doc_sections))
+            pending_rds.append(pool.apply_async(
+                write_rd, (rdoc_file, cmd_name, args_r, doc_sections)))
+
+    pool.close()
+    # get() re-raises any exception from a worker, so failed writes are
+    # not silently swallowed.
+    for pending in pending_rds:
+        pending.get()
+    pool.join()
 
-    print(R_TEMPLATE.format(methods=",\n".join(methods)))
+    out(R_FOOTER)
 
 if __name__ == "pymol":
     dump_cmds()